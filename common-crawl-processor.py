@@ -1,17 +1,100 @@
 import argparse
-import gzip
+import io
 import logging
 import os
 import re
-import shutil
+import sys
 import threading
 import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from urllib.parse import urljoin
 
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
 from warcio.archiveiterator import ArchiveIterator
 
+# ISA-L's gzip decoder is a drop-in replacement and much faster than zlib
+try:
+    from isal import igzip as gzip
+    from isal.isal_zlib import error as IsalError
+
+    _DECOMPRESS_ERRORS = (zlib.error, IsalError)
+except ImportError:
+    import gzip
+
+    _DECOMPRESS_ERRORS = (zlib.error,)
+
+# Hyperscan scans for the prefilter pattern far faster than re; optional
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+# Compiled once at import; these run against every WET record
+_POSTCODE_RE = re.compile(r"\b[A-Z]{1,2}[0-9][A-Z0-9]? [0-9][ABD-HJLNP-UW-Z]{2}\b")
+# Cheap check on the raw UTF-8 payload so pages without a BS postcode are
+# never decoded
+_BRISTOL_POSTCODE_BYTES_RE = re.compile(
+    rb"\bBS[0-9][A-Z0-9]? [0-9][ABD-HJLNP-UW-Z]{2}\b"
+)
+if hyperscan is not None:
+    _BRISTOL_POSTCODE_DB = hyperscan.Database()
+    _BRISTOL_POSTCODE_DB.compile(
+        expressions=[_BRISTOL_POSTCODE_BYTES_RE.pattern],
+        flags=[hyperscan.HS_FLAG_SINGLEMATCH],
+    )
+else:
+    _BRISTOL_POSTCODE_DB = None
+
+# WET record headers checked for every record, and the language we keep
+URI_HEADER = "WARC-Target-URI"
+LANGUAGE_HEADER = "WARC-Identified-Content-Language"
+ENGLISH = sys.intern("eng")
+
+# One session per process keeps the TLS connection to the crawl server alive
+# across retries and segments; retries are handled in process_wet_url
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://", HTTPAdapter(max_retries=0, pool_connections=4, pool_maxsize=16)
+)
+_SESSION.mount(
+    "http://", HTTPAdapter(max_retries=0, pool_connections=4, pool_maxsize=16)
+)
+# Errors a fresh download can fix: connection and HTTP failures, and the
+# truncated or corrupt gzip stream a dropped connection leaves behind
+RETRYABLE_ERRORS = (
+    requests.RequestException,
+    ProtocolError,
+    ReadTimeoutError,
+    EOFError,
+    OSError,
+) + _DECOMPRESS_ERRORS
+
+# Read buffer for decompressed WET data (the gzip default is 8 KiB)
+WET_READ_BUFFER_SIZE = 1 << 17
+# Read buffer for the compressed HTTP body, so the decompressor is fed in
+# large chunks instead of small socket reads
+DOWNLOAD_BUFFER_SIZE = 1 << 20
+
+# Free space (GB) required in the output directory before starting a segment
+MIN_FREE_GB = 2
+
+# Matched records are flushed to parquet in batches of this many rows
+OUTPUT_BATCH_ROWS = 1024
+OUTPUT_SCHEMA = pa.schema(
+    [
+        ("uri", pa.string()),
+        ("website", pa.string()),
+        ("postcodes", pa.list_(pa.string())),
+        ("text", pa.large_string()),
+    ]
+)
+
 
 def setup_logging(job_id=None):
     """Configure logging for the application"""
@@ -31,6 +114,8 @@ def setup_logging(job_id=None):
         format="%(asctime)s - %(levelname)s - %(message)s",
         handlers=[logging.FileHandler(log_filepath), logging.StreamHandler()],
     )
+    # Keep library chatter out of the per-record loop
+    logging.getLogger("warcio").setLevel(logging.WARNING)
     return logging.getLogger(__name__)
 
 
@@ -41,135 +126,250 @@ def heartbeat(logger, interval=300):
         time.sleep(interval)
 
 
-def download_file(url, output_path, max_retries=5, retry_delay=1, timeout=300):
-    """Download a file with retry logic and timeout"""
-    for attempt in range(max_retries):
-        try:
-            with requests.get(url, stream=True, timeout=timeout) as response:
-                response.raise_for_status()
-                with open(output_path, "wb") as f:
-                    shutil.copyfileobj(response.raw, f)
-            logging.info(f"Successfully downloaded {url} to {output_path}")
-            return True
-        except Exception as e:
-            if attempt < max_retries - 1:
-                logging.warning(
-                    f"Attempt {attempt + 1} failed: {e}. Retrying in {retry_delay} seconds..."
-                )
-                time.sleep(retry_delay)
-                retry_delay *= 2  # Exponential backoff
-            else:
-                logging.error(
-                    f"Failed to download {url} after {max_retries} attempts: {e}"
-                )
-                return False
-
-
 def postcode_finder(text):
-    postcodes = re.findall(
-        r"\b[A-Z]{1,2}[0-9][A-Z0-9]? [0-9][ABD-HJLNP-UW-Z]{2}\b", text
-    )
+    postcodes = _POSTCODE_RE.findall(text)
     return list(set(postcodes))
 
 
-def Bristol_postcode_finder(text, postcode_lookup):
-    postcodes = re.findall(
-        r"\b[A-Z]{1,2}[0-9][A-Z0-9]? [0-9][ABD-HJLNP-UW-Z]{2}\b", text
-    )
+def Bristol_postcode_finder(text, pcds_set):
+    # Only BS postcodes are kept, so skip the full regex on pages without one
+    if "BS" not in text:
+        return None
+    postcodes = _POSTCODE_RE.findall(text)
     postcodes = list(set(postcodes))
     postcodes = [postcode for postcode in postcodes if postcode.startswith("BS")]
-    matches = [
-        postcode for postcode in postcodes if postcode in postcode_lookup["pcds"].values
-    ]
+    matches = [postcode for postcode in postcodes if postcode in pcds_set]
     if matches:
         return matches
 
 
+def has_bristol_postcode(raw):
+    """Check whether a raw UTF-8 payload contains anything shaped like a BS postcode"""
+    if _BRISTOL_POSTCODE_DB is None:
+        return _BRISTOL_POSTCODE_BYTES_RE.search(raw) is not None
+    try:
+        # Returning True from the handler stops the scan at the first match
+        _BRISTOL_POSTCODE_DB.scan(raw, match_event_handler=lambda *match: True)
+    except hyperscan.ScanTerminated:
+        return True
+    return False
+
+
 def extract_website(url):
-    website = re.sub(r"\.uk/.*", ".uk", url)
-    website = website.replace("https://", "").replace("http://", "")
+    # Plain string ops; this runs for every kept record
+    host, sep, _ = url.partition(".uk/")
+    website = host + ".uk" if sep else url
+    if website.startswith("https://"):
+        return website[8:]
+    if website.startswith("http://"):
+        return website[7:]
     return website
 
 
-def process_wet_file(wet_file_path, output_path, postcode_lookup=None):
-    """Process a WET file and extract relevant information"""
-    results = []
+def extract_records(wet_source, writer, pcds_set=None, store_lowercase=False):
+    """Append matching records from a gzipped WET file or stream to writer"""
+    with gzip.open(wet_source, "rb") as gz, io.BufferedReader(
+        gz, buffer_size=WET_READ_BUFFER_SIZE
+    ) as f:
+        # WET records carry no HTTP headers, so skip warcio's attempt to parse them
+        for record in ArchiveIterator(f, no_record_parse=True):
+            # Reject records on their headers before touching the body
+            if record.rec_type != "conversion":
+                continue
+            # The 3-character language compare is cheaper than searching the URI
+            if record.rec_headers.get_header(LANGUAGE_HEADER) != ENGLISH:
+                continue
+            uri = record.rec_headers.get_header(URI_HEADER)
+            if ".co.uk/" not in uri:
+                continue
+
+            raw = record.content_stream().read()
+            if not has_bristol_postcode(raw):
+                continue
+            website = extract_website(uri)
+            text = raw.decode("utf-8", "ignore")
+            postcodes = Bristol_postcode_finder(text, pcds_set)
+
+            if postcodes is not None:
+                record_data = {
+                    "uri": uri,
+                    "website": website,
+                    "postcodes": postcodes,
+                    "text": text.lower() if store_lowercase else text,
+                }
+                writer.append(record_data)
+
+
+class RecordWriter:
+    """Stream extracted records to a parquet file in row-group sized batches.
+
+    The file is only created once the first batch is flushed, so a segment
+    with no matches leaves nothing behind. Batches go to a ".partial" sibling
+    that is renamed into place when the parquet footer has been written, so a
+    killed task never leaves an unreadable file at the crawldata*.parquet name.
+    """
+
+    def __init__(self, output_path, batch_rows=OUTPUT_BATCH_ROWS):
+        self.output_path = output_path
+        self.partial_path = output_path + ".partial"
+        self.batch_rows = batch_rows
+        self.count = 0
+        self._batch = []
+        self._writer = None
+
+    def append(self, record):
+        self._batch.append(record)
+        if len(self._batch) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._batch:
+            return
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(
+                self.partial_path,
+                OUTPUT_SCHEMA,
+                compression="zstd",
+                compression_level=3,
+                use_dictionary=["uri", "website"],
+            )
+        batch = pa.RecordBatch.from_pylist(self._batch, schema=OUTPUT_SCHEMA)
+        self._writer.write_batch(batch)
+        self.count += len(self._batch)
+        self._batch = []
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            os.replace(self.partial_path, self.output_path)
+
+    def discard(self):
+        """Drop buffered records and remove any partially written file"""
+        self._batch = []
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            os.remove(self.partial_path)
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
 
-    try:
-        with gzip.open(wet_file_path, "rb") as f:
-            for record in ArchiveIterator(f):
-                if record.rec_type == "conversion":
-                    uri = record.rec_headers.get_header("WARC-Target-URI")
-                    language = record.rec_headers.get_header(
-                        "WARC-Identified-Content-Language"
-                    )
-
-                    if (".co.uk/" in uri) & (language == "eng"):
-                        website = extract_website(uri)
-                        text = record.content_stream().read().decode("utf-8", "ignore")
-                        postcodes = Bristol_postcode_finder(text, postcode_lookup)
-                        text = text.lower()
-
-                        if postcodes is not None:
-                            record_data = {
-                                "uri": uri,
-                                "website": website,
-                                "postcodes": postcodes,
-                                "text": text,
-                            }
-                            results.append(record_data)
-    except Exception as e:
-        logging.error(f"Error processing {wet_file_path}: {e}")
 
-    if results:
-        df = pd.DataFrame(results)
-        df.to_parquet(output_path, engine="pyarrow", compression="snappy")
-        logging.info(f"Processed {len(results)} records from {wet_file_path}")
+class _ResponseBody(io.RawIOBase):
+    """Raw stream over a urllib3 response that can sit under io.BufferedReader.
+
+    urllib3 marks the response closed once the body is exhausted, which makes
+    BufferedReader raise instead of returning EOF.
+    """
+
+    def __init__(self, raw):
+        self._raw = raw
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self._raw.readinto(b)
+
+
+def log_record_count(count, source):
+    if count:
+        logging.info(f"Processed {count} records from {source}")
     else:
-        logging.warning(f"No records extracted from {wet_file_path}")
+        logging.warning(f"No records extracted from {source}")
+    return count
+
+
+def process_wet_url(
+    url,
+    output_path,
+    pcds_set=None,
+    store_lowercase=False,
+    max_retries=5,
+    retry_delay=1,
+    timeout=300,
+):
+    """
+    Stream a WET file from url, decompressing and filtering it as it downloads.
 
-    return len(results)
+    Nothing is written to disk except the parquet output. An attempt that
+    fails on the download discards its partial output and restarts the stream
+    from the beginning; any other error is raised at once.
+
+    Returns:
+        Number of records written, or None if every attempt failed
+    """
+    for attempt in range(max_retries):
+        writer = RecordWriter(output_path)
+        try:
+            with _SESSION.get(url, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                # The .gz body is the payload itself; never let urllib3 decode it
+                response.raw.decode_content = False
+                body = io.BufferedReader(
+                    _ResponseBody(response.raw), buffer_size=DOWNLOAD_BUFFER_SIZE
+                )
+                extract_records(body, writer, pcds_set, store_lowercase)
+            writer.close()
+            break
+        except RETRYABLE_ERRORS as e:
+            writer.discard()
+            if attempt < max_retries - 1:
+                logging.warning(
+                    f"Attempt {attempt + 1} failed: {e}. Retrying in {retry_delay} seconds..."
+                )
+                time.sleep(retry_delay)
+                retry_delay *= 2  # Exponential backoff
+            else:
+                logging.error(
+                    f"Failed to process {url} after {max_retries} attempts: {e}"
+                )
+                return None
+        except Exception:
+            # Bad input or a bug; downloading the file again will not help
+            writer.discard()
+            raise
+
+    return log_record_count(writer.count, url)
 
 
 def process_segment(
-    segment_number, wet_paths_file, server_url, output_dir, postcode_lookup=None
+    segment_number,
+    wet_path,
+    server_url,
+    output_dir,
+    crawl_date,
+    pcds_set=None,
+    store_lowercase=False,
 ):
     """Process a single segment"""
-    try:
-        with open(wet_paths_file, "r") as f:
-            paths = f.readlines()
-
-        if segment_number >= len(paths):
-            logging.error(
-                f"Segment number {segment_number} exceeds available paths ({len(paths)})"
-            )
-            return False
+    # Re-check before every segment so a filling disk stops the task cleanly
+    # instead of leaving half-written parquet files behind
+    if not check_disk_space(min_gb=MIN_FREE_GB, path=output_dir):
+        logging.error(f"Skipping segment {segment_number}: insufficient disk space")
+        return False
 
-        wet_path = paths[segment_number].strip()
+    try:
         file_url = urljoin(server_url, wet_path)
 
         segment_str = f"{segment_number:05d}"
-        gz_filename = f"crawldata{args.crawl_date}segment{segment_str}.wet.gz"
-        wet_filename = f"crawldata{args.crawl_date}segment{segment_str}.wet"
-        parquet_filename = f"crawldata{args.crawl_date}segment{segment_str}.parquet"
+        parquet_filename = f"crawldata{crawl_date}segment{segment_str}.parquet"
 
-        gz_filepath = os.path.join(output_dir, gz_filename)
-        wet_filepath = os.path.join(output_dir, wet_filename)
         parquet_filepath = os.path.join(output_dir, parquet_filename)
 
-        logging.info(f"Downloading {file_url} to {gz_filepath}")
-        if not download_file(file_url, gz_filepath):
-            logging.error(f"Failed to download {file_url}")
-            return False
-
-        logging.info(f"Processing {gz_filepath}")
-        records_processed = process_wet_file(
-            gz_filepath, parquet_filepath, postcode_lookup
+        logging.info(f"Streaming {file_url}")
+        records_processed = process_wet_url(
+            file_url, parquet_filepath, pcds_set, store_lowercase
         )
-
-        if os.path.exists(gz_filepath):
-            os.remove(gz_filepath)
-            logging.info(f"Removed {gz_filepath}")
+        if records_processed is None:
+            logging.error(f"Failed to process {file_url}")
+            return False
 
         logging.info(
             f"Completed processing segment {segment_number}: {records_processed} records"
@@ -182,18 +382,16 @@ def process_segment(
 
 
 def load_postcode_lookup(file_path):
-    """Load postcode lookup data if available"""
+    """Load the set of known postcodes from the lookup file if available"""
     if os.path.exists(file_path):
         try:
-            return pd.read_parquet(file_path)
+            table = pq.read_table(file_path, columns=["pcds"])
+            return frozenset(str(pc) for pc in table.column("pcds").to_pylist())
         except Exception as e:
             logging.error(f"Error loading postcode lookup file: {e}")
     return None
 
 
-import sys
-
-
 def main():
     parser = argparse.ArgumentParser(description="Process CommonCrawl WET files")
     parser.add_argument(
@@ -221,6 +419,11 @@ def main():
         default=1,
         help="Number of segments to process per task",
     )
+    parser.add_argument(
+        "--total-segments",
+        type=int,
+        help="Number of segments in the crawl; a task's range is clamped to it",
+    )
     parser.add_argument(
         "--segment",
         type=int,
@@ -233,6 +436,17 @@ def main():
         help="Path to postcode lookup file",
     )
     parser.add_argument("--job-id", type=str, help="Job ID for logging purposes")
+    parser.add_argument(
+        "--store-lowercase",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Store page text lowercased rather than as extracted",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of segments to process in parallel (default: one per available CPU)",
+    )
 
     global args
     args = parser.parse_args()
@@ -251,10 +465,13 @@ def main():
     os.makedirs(args.output_dir, exist_ok=True)
 
     # Load postcode lookup data
-    postcode_lookup = load_postcode_lookup(args.postcode_lookup)
+    pcds_set = load_postcode_lookup(args.postcode_lookup)
+    if pcds_set is None:
+        logger.error(f"Postcode lookup {args.postcode_lookup} could not be loaded")
+        sys.exit(1)
 
     # Check disk space before downloading
-    if not check_disk_space(min_gb=2):
+    if not check_disk_space(min_gb=MIN_FREE_GB, path=args.output_dir):
         print("Insufficient disk space, exiting safely")
         sys.exit(121)  # Custom exit code for disk space
 
@@ -267,6 +484,9 @@ def main():
         # Array job mode with explicitly provided task ID
         start_segment = args.task_id * args.segments_per_task
         end_segment = start_segment + args.segments_per_task
+        # The last task of a crawl may have fewer than segments_per_task segments
+        if args.total_segments is not None:
+            end_segment = min(end_segment, args.total_segments)
         segment_numbers = list(range(start_segment, end_segment))
         logger.info(
             f"Task {args.task_id} processing segments {start_segment} to {end_segment - 1}"
@@ -275,19 +495,41 @@ def main():
         logger.error("No segment specified and no task ID provided")
         return
 
+    # Read wet.paths once for the whole task rather than once per segment
+    with open(args.wet_paths, "r") as f:
+        paths = [line.strip() for line in f]
+
+    valid_segments = []
+    for segment_number in segment_numbers:
+        if segment_number >= len(paths):
+            logger.error(
+                f"Segment number {segment_number} exceeds available paths ({len(paths)})"
+            )
+        else:
+            valid_segments.append(segment_number)
+
     logger.info(f"Using server URL: {args.server_url}")
     logger.info(f"Output directory: {args.output_dir}")
 
-    successful_segments = 0
-    for segment_number in segment_numbers:
-        if process_segment(
-            segment_number,
-            args.wet_paths,
-            args.server_url,
-            args.output_dir,
-            postcode_lookup,
-        ):
-            successful_segments += 1
+    # Segments are independent, so spread them over the CPUs SLURM gave us
+    workers = args.workers or len(os.sched_getaffinity(0))
+    workers = max(1, min(workers, len(valid_segments)))
+    logger.info(f"Processing {len(valid_segments)} segments with {workers} workers")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            partial(
+                process_segment,
+                server_url=args.server_url,
+                output_dir=args.output_dir,
+                crawl_date=args.crawl_date,
+                pcds_set=pcds_set,
+                store_lowercase=args.store_lowercase,
+            ),
+            valid_segments,
+            [paths[segment_number] for segment_number in valid_segments],
+        )
+        successful_segments = sum(results)
 
     logger.info(
         f"Processing completed: {successful_segments}/{len(segment_numbers)} segments successful"
@@ -299,10 +541,10 @@ def main():
     sys.exit(0)
 
 
-def check_disk_space(min_gb=5):
+def check_disk_space(min_gb=5, path="."):
     """Check available disk space before downloading"""
-    total, used, free = shutil.disk_usage(".")
-    free_gb = free // (1024**3)
+    stats = os.statvfs(path)
+    free_gb = stats.f_bavail * stats.f_frsize // (1024**3)
 
     if free_gb < min_gb:
         print(f"WARNING: Low disk space! {free_gb}GB remaining")
@@ -4,7 +4,23 @@ CRAWL_DATE=$date
 # Number of segments to process per task
 SEGMENTS_PER_TASK=$segments_per_task
 
-echo "Processing crawl date: $date"
+# Number of files in the crawl; the last task's segment range stops here
+TOTAL_FILES=$n_files
+
+# Which block of SEGMENTS_PER_TASK segments this task processes
+TASK_INDEX=${SLURM_ARRAY_TASK_ID}
+
+# In single-array mode one array spans every crawl date; look up this
+# task's crawl date and segment range in the mapping table
+MAPPING_FILE="$mapping_file"
+if [ -n "${MAPPING_FILE}" ]; then
+    set -- $(awk -F'\t' -v id="${SLURM_ARRAY_TASK_ID}" '$1 == id' "${MAPPING_FILE}")
+    CRAWL_DATE=$2
+    TASK_INDEX=$(($3 / SEGMENTS_PER_TASK))
+    TOTAL_FILES=$4
+fi
+
+echo "Processing crawl date: ${CRAWL_DATE}"
 echo "Total files in this crawl: $n_files"
 
 # Print task information for logging
@@ -28,9 +44,10 @@ trap cleanup EXIT INT TERM
 # Run the python script with explicitly passed task ID using conda environment
 ./.conda_env/bin/python common-crawl-processor.py \
   --crawl-date ${CRAWL_DATE} \
-  --task-id ${SLURM_ARRAY_TASK_ID} \
+  --task-id ${TASK_INDEX} \
   --job-id "${SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID}" \
   --segments-per-task ${SEGMENTS_PER_TASK} \
+  --total-segments ${TOTAL_FILES} \
   --wet-paths wet.paths \
   --output-dir "$WORKING_DIR/output" \
   --postcode-lookup BristolPostcodeLookup.parquet
@@ -72,28 +72,40 @@ echo ""
 echo "${GREEN}1. Current Slurm Jobs${RESET}"
 echo "-------------------------"
 if command -v squeue >/dev/null 2>&1; then
+    # Query squeue once and derive the counts, details and time limits below
+    # from this snapshot instead of hitting the controller for each section
+    SQUEUE_ARGS=(-A "$SLURM_ACCOUNT" -u "$USER")
+    if [[ -n "${JOB_SELECTOR_ID:-}" ]]; then
+        SQUEUE_ARGS+=(-j "$JOB_SELECTOR_ID")
+    fi
+    # '|'-separated because job names (%j) can contain spaces
+    SQUEUE_SNAPSHOT=$(squeue "${SQUEUE_ARGS[@]}" --noheader --format="%i|%P|%j|%T|%l|%M|%D|%R" --states=RUNNING,PENDING || true)
+    RUNNING=$(awk -F'|' '$4 == "RUNNING"' <<<"$SQUEUE_SNAPSHOT" | wc -l)
+    PENDING=$(awk -F'|' '$4 == "PENDING"' <<<"$SQUEUE_SNAPSHOT" | wc -l)
+
     if [[ -n "${JOB_SELECTOR_ID:-}" ]]; then
-        RUNNING=$(squeue -A "$SLURM_ACCOUNT" -u $USER -j "$JOB_SELECTOR_ID" --format="%i %P %j %T %l %D" --state=RUNNING | wc -l)
-        PENDING=$(squeue -A "$SLURM_ACCOUNT" -u $USER -j "$JOB_SELECTOR_ID" --format="%i %P %j %T %l %D" --state=PENDING | wc -l)
         COMPLETED=$(sacct -A "$SLURM_ACCOUNT" -u $USER -j "$JOB_SELECTOR_ID" --format="JobID,JobName,State,Elapsed,MaxRSS" --state=COMPLETED | tail -n +2 | wc -l || echo 0)
     else
         # No specific job id: list all jobs for user
-        RUNNING=$(squeue -A "$SLURM_ACCOUNT" -u $USER --format="%i %P %j %T %l %D" --state=RUNNING | wc -l)
-        PENDING=$(squeue -A "$SLURM_ACCOUNT" -u $USER --format="%i %P %j %T %l %D" --state=PENDING | wc -l)
         COMPLETED=$(sacct -A "$SLURM_ACCOUNT" -u $USER --format="JobID,JobName,State,Elapsed,MaxRSS" --state=COMPLETED | tail -n +2 | wc -l || echo 0)
     fi
 
-    echo "Running jobs: $((RUNNING - 1))  (includes header row)"
-    echo "Pending jobs: $((PENDING - 1))"
+    echo "Running jobs: $RUNNING"
+    echo "Pending jobs: $PENDING"
     echo "Recent completed jobs: $COMPLETED"
     
     # Detailed running jobs
     echo ""
     echo "Running/Pending Details:"
-    if [[ -n "${JOB_SELECTOR_ID:-}" ]]; then
-        squeue -A "$SLURM_ACCOUNT" -u $USER -j "$JOB_SELECTOR_ID" --format="%i %P %j %T %l %M %D %R" --states=RUNNING,PENDING || echo "No matching jobs found."
+    if [[ -n "$SQUEUE_SNAPSHOT" ]]; then
+        DETAILS=$(printf '%s\n' "JOBID|PARTITION|NAME|STATE|TIME_LIMIT|TIME|NODES|NODELIST(REASON)" "$SQUEUE_SNAPSHOT")
+        if command -v column >/dev/null 2>&1; then
+            column -t -s'|' <<<"$DETAILS"
+        else
+            tr '|' ' ' <<<"$DETAILS"
+        fi
     else
-        squeue -A "$SLURM_ACCOUNT" -u $USER --format="%i %P %j %T %l %M %D %R" --states=RUNNING,PENDING || echo "No matching jobs found."
+        echo "No matching jobs found."
     fi
 else
     echo "${RED}Warning: squeue not available (not on Slurm cluster?).${RESET}"
@@ -118,12 +130,11 @@ for DATE in "${CRAWL_DATES[@]}"; do
     fi
 done
 
-# Count processed (Parquet files exist and non-empty)
-for PARQUET in "$OUTPUT_DIR"/crawldata*.parquet; do
-    if [[ -f "$PARQUET" && -s "$PARQUET" ]]; then  # Non-empty
-        PROCESSED_SEGMENTS=$((PROCESSED_SEGMENTS + 1))
-    fi
-done
+# Count processed (Parquet files exist and non-empty); find checks type and
+# size from a single stat per file instead of separate -f and -s tests
+if [[ -d "$OUTPUT_DIR" ]]; then
+    PROCESSED_SEGMENTS=$(find "$OUTPUT_DIR" -maxdepth 1 -name "crawldata*.parquet" -type f -size +0 -printf '.' | wc -c)
+fi
 
 # Protect against division by zero when no segments are listed
 if [[ $TOTAL_SEGMENTS -le 0 ]]; then
@@ -189,13 +200,9 @@ slurm_time_to_seconds() {
     echo "$t"
 }
 
-# Query squeue for elapsed and limit (use job id if set, else first running job for user)
+# Elapsed and limit of the first running job in the squeue snapshot (job id if set, else any for user)
 if command -v squeue >/dev/null 2>&1; then
-    if [[ -n "${JOB_SELECTOR_ID:-}" ]]; then
-        line=$(squeue -A "$SLURM_ACCOUNT" -u $USER -j "$JOB_SELECTOR_ID" -o "%M %l" --noheader --states=RUNNING | head -n1 || true)
-    else
-        line=$(squeue -A "$SLURM_ACCOUNT" -u $USER -o "%M %l" --noheader --states=RUNNING | head -n1 || true)
-    fi
+    line=$(awk -F'|' '$4 == "RUNNING" {print $6, $5; exit}' <<<"$SQUEUE_SNAPSHOT")
 
     if [[ -n "$line" ]]; then
         elapsed_str=$(awk '{print $1}' <<<"$line")
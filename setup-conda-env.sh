@@ -24,7 +24,7 @@ fi
 
 # Install required packages
 echo "Installing required packages..."
-./.conda_env/bin/pip install simple-slurm pandas pyarrow warcio requests
+./.conda_env/bin/pip install simple-slurm pandas pyarrow warcio requests isal hyperscan
 
 echo "Environment setup complete!"
 echo "To use: ./.conda_env/bin/python your_script.py"
\ No newline at end of file
@@ -124,10 +124,9 @@ completed_dates=0
 current_date=""
 
 if [[ -d "$WORKING_DIR" ]]; then
-    # Count all parquet files
-    while IFS= read -r -d '' file; do
-        [[ -s "$file" ]] && completed_files=$((completed_files + 1))
-    done < <(find "$WORKING_DIR" -name "crawldata*.parquet" -print0 2>/dev/null)
+    # Count non-empty parquet files; let find test the size from the stat it
+    # already does rather than re-testing every file from the shell
+    completed_files=$(find "$WORKING_DIR" -name "crawldata*.parquet" -type f -size +0 -printf '.' 2>/dev/null | wc -c) || true
 fi
 
 remaining_files=$((total_files - completed_files))
@@ -1,144 +1,764 @@
 import argparse
 import datetime
+import functools
+import io
 import os
+import shutil
 import string
 import subprocess
+import tarfile
+import tempfile
+import threading
 import time
+from pathlib import Path
 
 from simple_slurm import Slurm
 
+# sacct states from which a job will not run again
+TERMINAL_JOB_STATES = frozenset(
+    {
+        "BOOT_FAIL",
+        "CANCELLED",
+        "COMPLETED",
+        "DEADLINE",
+        "FAILED",
+        "NODE_FAIL",
+        "OUT_OF_MEMORY",
+        "PREEMPTED",
+        "TIMEOUT",
+    }
+)
+
 
 def load_template_file(template_file):
     """Load command template from a file."""
-    if not os.path.exists(template_file):
-        raise FileNotFoundError(f"Template file not found: {template_file}")
+    try:
+        return Path(template_file).read_text(encoding="utf-8")
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Template file not found: {template_file}") from None
 
-    with open(template_file, "r") as f:
-        template_content = f.read()
 
-    return template_content
+def load_crawl_dates(crawl_dates_file):
+    """
+    Read `date n_files` pairs from a crawl dates file.
+
+    Lines starting with '#' and lines with fewer than two fields are skipped.
 
+    Returns:
+        Tuple of (crawl date strings, file counts)
+    """
+    crawl_dates = []
+    n_files_list = []
+    with open(crawl_dates_file, "r") as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            parts = line.split()
+            if len(parts) >= 2:
+                crawl_dates.append(parts[0])
+                n_files_list.append(int(parts[1]))
+    return crawl_dates, n_files_list
+
+
+class PresplitTemplate(string.Template):
+    """
+    string.Template that splits its text around placeholders once, so each
+    safe_substitute is a join over precomputed pieces instead of a regex pass.
+    """
 
-def create_template_command(template_content, variables):
-    """Create a command from a template string and variables dictionary."""
-    template = string.Template(template_content)
+    def __init__(self, template):
+        super().__init__(template)
+        # Literal text around each (name, original text) placeholder, with
+        # $$ escapes and invalid placeholders already folded into the literals
+        self._literals = []
+        self._placeholders = []
+        literal = []
+        last = 0
+        for match in self.pattern.finditer(template):
+            literal.append(template[last : match.start()])
+            last = match.end()
+            name = match.group("named") or match.group("braced")
+            if name is not None:
+                self._literals.append("".join(literal))
+                self._placeholders.append((name, match.group()))
+                literal = []
+            elif match.group("escaped") is not None:
+                literal.append(self.delimiter)
+            else:
+                literal.append(match.group())
+        literal.append(template[last:])
+        self._literals.append("".join(literal))
+
+    def safe_substitute(self, mapping=None, **kws):
+        values = {**(mapping or {}), **kws}
+        parts = [self._literals[0]]
+        for (name, original), literal in zip(self._placeholders, self._literals[1:]):
+            # Unknown placeholders are left as written, as safe_substitute does
+            parts.append(str(values[name]) if name in values else original)
+            parts.append(literal)
+        return "".join(parts)
+
+
+def create_template_command(template, variables):
+    """Create a command from a compiled string.Template and variables dictionary."""
     return template.safe_substitute(variables)
 
 
-def submit_and_wait_for_job(
+def squeue_has_only_job_state():
+    """Check whether squeue accepts --only-job-state, which is answered from
+    the controller's job state cache instead of full job records."""
+    try:
+        result = subprocess.run(
+            ["squeue", "--help"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=False,
+        )
+    except OSError:
+        return False
+    return b"--only-job-state" in result.stdout
+
+
+def sacct_job_states(job_id):
+    """
+    Return the distinct accounting states of the job's array tasks, sorted.
+
+    Returns an empty list if sacct is unavailable or has no record of the job.
+    """
+    try:
+        result = subprocess.run(
+            [
+                "sacct",
+                "-j",
+                str(job_id),
+                "-X",
+                "--parsable2",
+                "--noheader",
+                "--format=State",
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Could not confirm state of job {job_id} with sacct: {e}")
+        return []
+    # Large arrays give one line per task, so work on bytes and only decode
+    # the distinct states. Cancelled jobs are reported as "CANCELLED by <uid>".
+    states = {
+        line.split(None, 1)[0] for line in result.stdout.splitlines() if line.strip()
+    }
+    return sorted(state.decode() for state in states)
+
+
+def squeue_has_job(job_id, only_job_state=False):
+    """
+    One-shot check whether job_id is still in the queue.
+
+    squeue rejects job ids the controller no longer knows, which counts as
+    gone, as does any other failure; sacct then confirms the final state.
+    """
+    cmd = ["squeue", "-h", "-o", "%i,%T", "-j", str(job_id)]
+    if only_job_state:
+        cmd.insert(1, "--only-job-state")
+    try:
+        result = subprocess.run(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    job_id = str(job_id).encode()
+    for line in result.stdout.splitlines():
+        row_id, _, state = line.partition(b",")
+        # With -j squeue also lists finished jobs until they are purged
+        if (
+            row_id.split(b"_", 1)[0].split(b"+", 1)[0] == job_id
+            and state.decode() not in TERMINAL_JOB_STATES
+        ):
+            return True
+    return False
+
+
+class SqueueCache:
+    """
+    Job states for the jobs being waited on, read from one `squeue --iterate` stream.
+
+    A reader thread turns each iteration into a {job_id: state} snapshot and
+    notifies waiters through a condition variable, so any number of concurrent
+    waits cost a single controller RPC per interval.
+
+    With only_job_state the stream asks for the watched job ids with -j, as
+    --only-job-state cannot be combined with user filters like --me, and is
+    restarted whenever that set changes.
+    """
+
+    def __init__(self, only_job_state=False):
+        self.only_job_state = only_job_state
+        self._condition = threading.Condition()
+        self._proc = None
+        self._interval = None
+        self._stream_jobs = None
+        self._snapshots = 0
+        # Set once a stream exits before producing any output; waits then fall
+        # back to one-shot `squeue -j` checks
+        self._stream_failed = False
+        self._generation = 0
+        self._watched = {}
+        # Final sacct states of jobs already seen finished; never queried again
+        self._finalized = {}
+
+    def stop(self):
+        """Stop the squeue stream if it is running."""
+        with self._condition:
+            self._stop()
+
+    def wait_until_terminal(self, job_id, check_interval=60, max_check_interval=None):
+        """
+        Block until job_id has left the queue and sacct reports it finished.
+
+        Checks quickly at first to catch short jobs, then backs off to
+        max_check_interval (default: 5 * check_interval) since most jobs run
+        for hours.
+
+        Returns:
+            sacct states of the job's array tasks (empty if sacct has no record)
+        """
+        job_id = str(job_id)
+        if max_check_interval is None:
+            max_check_interval = check_interval * 5
+
+        interval = min(5, check_interval)
+        while job_id not in self._finalized:
+            # Keep the backoff reached so far; a job that drops out of squeue
+            # while sacct says it is still running is not a short job
+            interval = self._wait_until_gone(job_id, interval, max_check_interval)
+
+            # Jobs can drop out of squeue briefly (e.g. controller restart), so
+            # confirm with accounting before treating the job as finished
+            states = sacct_job_states(job_id)
+            if all(state in TERMINAL_JOB_STATES for state in states):
+                self._finalized[job_id] = states
+            else:
+                print(
+                    f"Job {job_id} left squeue but sacct reports "
+                    f"{', '.join(states)}; still waiting..."
+                )
+
+        return self._finalized[job_id]
+
+    def _wait_until_gone(self, job_id, interval, max_interval):
+        """Block until job_id has left the queue and return the interval reached."""
+        with self._condition:
+            watch = {
+                "generation": self._generation,
+                "seen": False,
+                "gone": False,
+                "interval": interval,
+            }
+            self._watched[job_id] = watch
+            try:
+                while not self._stream_failed:
+                    self._retune()
+                    if self._condition.wait_for(
+                        lambda: watch["gone"] or self._stream_failed, timeout=interval
+                    ):
+                        break
+                    interval = min(interval * 2, max_interval)
+                    watch["interval"] = interval
+                    print(
+                        f"Job {job_id} still running. Checking again in {interval} seconds..."
+                    )
+            finally:
+                del self._watched[job_id]
+                if self.only_job_state and not self._stream_failed:
+                    # Drop the job from the stream's -j list
+                    if self._watched:
+                        self._retune()
+                    else:
+                        self._stop()
+            if watch["gone"]:
+                return interval
+
+        while squeue_has_job(job_id, self.only_job_state):
+            print(
+                f"Job {job_id} still running. Checking again in {interval} seconds..."
+            )
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+        return interval
+
+    def _retune(self):
+        """(Re)start the stream at the shortest interval any waiter wants."""
+        interval = min(watch["interval"] for watch in self._watched.values())
+        jobs = sorted(self._watched) if self.only_job_state else None
+        if (
+            self._proc is None
+            or interval != self._interval
+            or jobs != self._stream_jobs
+        ):
+            self._start(interval, jobs)
+        elif self._proc.poll() is not None and self._snapshots:
+            # The stream worked before, so restart it; one that never produced
+            # a snapshot is reported by its reader as failed instead
+            self._start(interval, jobs)
+
+    def _start(self, interval, jobs=None):
+        """Start the squeue stream, replacing any stream already running."""
+        self._stop()
+        if jobs is None:
+            cmd = ["squeue", "--me"]
+        else:
+            cmd = ["squeue", "--only-job-state", "-j", ",".join(jobs)]
+        cmd += ["-i", str(interval), "--format=%i,%T"]
+        # squeue block-buffers its output when piped; force line buffering so
+        # each iteration is seen as soon as it is printed
+        if shutil.which("stdbuf"):
+            cmd = ["stdbuf", "-oL"] + cmd
+        # stderr goes to a file so a long-running stream can never block on a
+        # full pipe; it is only read back if squeue exits
+        stderr = tempfile.TemporaryFile()
+        try:
+            self._proc = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                text=True,
+                bufsize=1,
+            )
+        except OSError as e:
+            stderr.close()
+            print(f"Could not start squeue stream: {e}")
+            print("Falling back to checking each job with squeue -j")
+            self._stream_failed = True
+            return
+        self._interval = interval
+        self._stream_jobs = jobs
+        self._snapshots = 0
+        threading.Thread(
+            target=self._read, args=(self._proc, stderr), daemon=True
+        ).start()
+
+    def _stop(self):
+        proc, self._proc, self._interval = self._proc, None, None
+        self._stream_jobs = None
+        if proc is not None and proc.poll() is None:
+            proc.terminate()
+            proc.wait()
+
+    def _read(self, proc, stderr):
+        """Parse `squeue --iterate` output and publish one snapshot per iteration."""
+        try:
+            self._read_snapshots(proc)
+        finally:
+            returncode = proc.wait()
+            stderr.seek(0, os.SEEK_END)
+            stderr.seek(max(0, stderr.tell() - 2048))
+            message = stderr.read().decode(errors="replace").strip()
+            stderr.close()
+            self._stream_exited(proc, returncode, message)
+
+    def _read_snapshots(self, proc):
+        snapshot = None
+        for line in proc.stdout:
+            line = line.strip()
+            if line == "JOBID,STATE":
+                continue
+            if not line or "," not in line:
+                # A blank line ends an iteration; the timestamp squeue prints
+                # before each query starts the next one
+                if snapshot is not None:
+                    self._publish(proc, snapshot)
+                snapshot = {} if line else None
+                continue
+            if snapshot is not None:
+                job_id, state = line.split(",", 1)
+                # With -j squeue also lists finished jobs until they are purged
+                if state in TERMINAL_JOB_STATES:
+                    continue
+                # Match on the job id field alone: array jobs are listed as
+                # <job_id>_<task> or <job_id>_[<range>], heterogeneous job
+                # components as <job_id>+<offset>
+                snapshot[job_id.split("_", 1)[0].split("+", 1)[0]] = state
+
+    def _stream_exited(self, proc, returncode, message):
+        """Report a stream that stopped on its own and wake waiters if it failed."""
+        with self._condition:
+            # Streams replaced or stopped by us are expected to exit
+            if proc is not self._proc:
+                return
+            print(
+                f"squeue stream exited with code {returncode}"
+                + (f": {message}" if message else "")
+            )
+            if not self._snapshots:
+                print("Falling back to checking each job with squeue -j")
+                self._stream_failed = True
+                self._condition.notify_all()
+
+    def _publish(self, proc, snapshot):
+        """Swap in a new snapshot and wake waiters whose job has left the queue."""
+        with self._condition:
+            # Drop output still buffered from a stream that has been replaced
+            if proc is not self._proc:
+                return
+            self._snapshots += 1
+            self._generation += 1
+            for job_id, watch in self._watched.items():
+                if job_id in snapshot:
+                    watch["seen"] = True
+                # A snapshot may have been queried just before the job was
+                # submitted, so a job never seen only counts as gone after two
+                # fresh iterations
+                elif watch["seen"] or self._generation >= watch["generation"] + 2:
+                    watch["gone"] = True
+            self._condition.notify_all()
+
+
+# Shared by every wait in this process
+_squeue_cache = SqueueCache()
+
+
+def _sbatch_lines(params):
+    """Format `#SBATCH` lines as Slurm.script() does, as (key, line) pairs."""
+    lines = []
+    for key, value in params.items():
+        if not value:
+            continue
+        if isinstance(value, datetime.timedelta):
+            minutes, seconds = divmod(value.seconds, 60)
+            hours, minutes = divmod(minutes, 60)
+            value = f"{value.days}-{hours:02}:{minutes:02}:{seconds:02}"
+        lines.append((key, f"#SBATCH --{key.replace('_', '-'):<19} {value}"))
+    return lines
+
+
+@functools.lru_cache(maxsize=None)
+def _resource_sbatch_lines(partition, time_limit, mem, cpus_per_task):
+    """`#SBATCH` lines shared by every date's job, formatted once per run."""
+    return _sbatch_lines(
+        {
+            "partition": partition,
+            "time": time_limit,
+            "mem": mem,
+            "cpus_per_task": cpus_per_task,
+        }
+    )
+
+
+# Dry-run scripts are written here; main creates it once per run
+GENERATED_SCRIPTS_DIR = "generated_scripts"
+
+
+def submit_command(
+    job_name,
+    command,
+    array_size,
+    partition=None,
+    time_limit=None,
+    mem=None,
+    cpus_per_task=None,
+    throttle=50,
+    after_job_id=None,
+    dry_run=False,
+    scripts_archive=None,
+):
+    """
+    Submit a command as a SLURM (array) job, or write its script in dry-run mode.
+
+    Returns:
+        Job ID of the submitted job (or None in dry-run mode)
+    """
+    # Per-job parameters
+    job_workdir = os.environ.get("WORKING_DIR", ".")
+    job_params = {
+        "job_name": job_name,
+        "output": f"{job_workdir}/{job_name}_%j.out",
+        "error": f"{job_workdir}/{job_name}_%j.err",
+    }
+
+    # Let the Slurm controller sequence the dates; afterany starts this job
+    # whether or not the previous one succeeded
+    if after_job_id:
+        job_params["dependency"] = f"afterany:{after_job_id}"
+
+    # Create array based on n_files - each array task processes a block of
+    # segments_per_task files. A single task still needs an array (0-0) so the
+    # template gets a SLURM_ARRAY_TASK_ID.
+    if array_size >= 1:
+        job_params["array"] = f"0-{array_size - 1}%{throttle}"
+
+    if dry_run:
+        # Write the script Slurm.script() would generate without building a
+        # Slurm object; simple_slurm orders these options alphabetically
+        sbatch_lines = sorted(
+            _resource_sbatch_lines(partition, time_limit, mem, cpus_per_task)
+            + _sbatch_lines(job_params)
+        )
+        header = "\n".join(line for _, line in sbatch_lines)
+        body = command.strip().replace("$", "\\$")
+
+        script = f"#!/bin/sh\n\n{header}\n\n{body}\n"
+
+        # Output the generated SLURM script instead of submitting it
+        if scripts_archive is not None:
+            # One archive avoids a file create per script on network filesystems
+            data = script.encode()
+            info = tarfile.TarInfo(f"{job_name}.sh")
+            info.size = len(data)
+            info.mtime = int(time.time())
+            scripts_archive.addfile(info, io.BytesIO(data))
+            script_path = f"{scripts_archive.name}:{job_name}.sh"
+        else:
+            script_path = os.path.join(GENERATED_SCRIPTS_DIR, f"{job_name}.sh")
+            with open(script_path, "w") as script_file:
+                script_file.write(script)
+        print(
+            f"\n[DRY-RUN] Generated SLURM script for job {job_name} saved to {script_path}\n"
+        )
+        return None
+
+    # Add optional parameters if provided
+    slurm_params = dict(job_params)
+    if partition:
+        slurm_params["partition"] = partition
+    if time_limit:
+        slurm_params["time"] = time_limit
+    if mem:
+        slurm_params["mem"] = mem
+    if cpus_per_task:
+        slurm_params["cpus_per_task"] = cpus_per_task
+
+    # Create Slurm object
+    slurm = Slurm(**slurm_params)
+    slurm.add_cmd(command)
+
+    return slurm.sbatch()
+
+
+def submit_only(
     date,
     n_files,
-    template_content,
+    template,
     job_name_prefix="batch_job",
     partition=None,
     time_limit=None,
     mem=None,
     cpus_per_task=None,
-    check_interval=60,
     segments_per_task=100,
     throttle=50,
+    after_job_id=None,
     dry_run=False,
+    scripts_archive=None,
 ):
     """
-    Submit a job for one crawl date and wait for it to complete before returning.
+    Submit a job for one crawl date without waiting for it.
 
     Args:
         date: Crawl date string
         n_files: Number of files for this crawl date
-        template_content: Template content loaded from file
+        template: string.Template compiled from the template file
         job_name_prefix: Prefix for job name
         partition: SLURM partition (optional)
         time_limit: Time limit as datetime.timedelta (optional)
         mem: Memory request (optional)
         cpus_per_task: CPUs per task (optional)
-        check_interval: How often to check job status in seconds
         segments_per_task: Number of segments per task
+        after_job_id: Only start once this job has finished (optional)
         dry_run: If True, do not submit the job; just output the generated script
+        scripts_archive: Open tarfile to add dry-run scripts to instead of
+            writing them to generated_scripts/ (optional)
 
     Returns:
-        Job ID of the completed job (or None in dry-run mode)
+        Job ID of the submitted job (or None in dry-run mode)
     """
 
-    array_size = n_files // segments_per_task
+    # Round up so the last task picks up the remaining files; the template
+    # clamps that task's segment range to n_files
+    array_size = -(-n_files // segments_per_task)
 
     # Create variables dictionary for template substitution
     variables = {
         "date": date,
         "n_files": n_files,
         "segments_per_task": segments_per_task,
+        "mapping_file": "",
     }
 
     # Create command from template
-    command = create_template_command(template_content, variables)
+    command = create_template_command(template, variables)
 
     # Define job name
     job_name = f"{job_name_prefix}_{date}"
 
-    # Create Slurm object with parameters
-    job_workdir = os.environ.get("WORKING_DIR", ".")
-    slurm_params = {
-        "job_name": job_name,
-        "output": f"{job_workdir}/{job_name}_%j.out",
-        "error": f"{job_workdir}/{job_name}_%j.err",
+    job_id = submit_command(
+        job_name,
+        command,
+        array_size,
+        partition=partition,
+        time_limit=time_limit,
+        mem=mem,
+        cpus_per_task=cpus_per_task,
+        throttle=throttle,
+        after_job_id=after_job_id,
+        dry_run=dry_run,
+        scripts_archive=scripts_archive,
+    )
+    if job_id is None:
+        return None
+
+    if after_job_id:
+        print(f"Submitted job {job_id} for date {date} (after job {after_job_id})")
+    else:
+        print(f"Submitted job {job_id} for date {date}")
+
+    return job_id
+
+
+def write_task_mapping(mapping_file, crawl_dates, n_files_list, segments_per_task):
+    """
+    Write the array task table used in single-array mode.
+
+    Each row is `task_id, date, segment_start, segment_end` (tab separated,
+    segment_end exclusive and clamped to the date's file count), numbering
+    tasks across all crawl dates in order.
+
+    Returns:
+        Total number of array tasks
+    """
+    task_id = 0
+    with open(mapping_file, "w") as f:
+        for date, n_files in zip(crawl_dates, n_files_list):
+            for segment_start in range(0, n_files, segments_per_task):
+                segment_end = min(segment_start + segments_per_task, n_files)
+                f.write(f"{task_id}\t{date}\t{segment_start}\t{segment_end}\n")
+                task_id += 1
+    return task_id
+
+
+def submit_single_array(
+    crawl_dates,
+    n_files_list,
+    template,
+    mapping_file="mapping.tsv",
+    job_name_prefix="batch_job",
+    partition=None,
+    time_limit=None,
+    mem=None,
+    cpus_per_task=None,
+    segments_per_task=100,
+    throttle=50,
+    dry_run=False,
+    scripts_archive=None,
+):
+    """
+    Submit one array job covering every crawl date.
+
+    Array task IDs index into the mapping table written to mapping_file, which
+    the job template reads to find each task's crawl date and segments. The
+    whole array must fit within the cluster's MaxArraySize.
+
+    Returns:
+        Job ID of the submitted job (or None in dry-run mode)
+    """
+    mapping_file = os.path.abspath(mapping_file)
+    array_size = write_task_mapping(
+        mapping_file, crawl_dates, n_files_list, segments_per_task
+    )
+    print(
+        f"Wrote {array_size} array tasks for {len(crawl_dates)} dates to {mapping_file}"
+    )
+
+    variables = {
+        "date": "",
+        "n_files": sum(n_files_list),
+        "segments_per_task": segments_per_task,
+        "mapping_file": mapping_file,
     }
+    command = create_template_command(template, variables)
+    job_name = f"{job_name_prefix}_all"
+
+    job_id = submit_command(
+        job_name,
+        command,
+        array_size,
+        partition=partition,
+        time_limit=time_limit,
+        mem=mem,
+        cpus_per_task=cpus_per_task,
+        throttle=throttle,
+        dry_run=dry_run,
+        scripts_archive=scripts_archive,
+    )
+    if job_id is not None:
+        print(f"Submitted job {job_id} for dates {', '.join(crawl_dates)}")
 
-    # Add optional parameters if provided
-    if partition:
-        slurm_params["partition"] = partition
-    if time_limit:
-        slurm_params["time"] = time_limit
-    if mem:
-        slurm_params["mem"] = mem
-    if cpus_per_task:
-        slurm_params["cpus_per_task"] = cpus_per_task
+    return job_id
 
-    # Create array based on n_files - each array task will process one file
-    if array_size > 1:
-        slurm_params["array"] = f"0-{array_size - 1}%{throttle}"
 
-    # Create Slurm object
-    slurm = Slurm(**slurm_params)
-    slurm.add_cmd(command)
+def wait_for_job(job_id, date, check_interval=60, max_check_interval=None):
+    """
+    Wait for a submitted job to finish.
 
-    if dry_run:
-        # Output the generated SLURM script to a file instead of submitting it
-        os.makedirs("generated_scripts", exist_ok=True)
-        script_path = os.path.join("generated_scripts", f"{job_name}.sh")
-        with open(script_path, "w") as script_file:
-            script_file.write(slurm.script())
-        print(
-            f"\n[DRY-RUN] Generated SLURM script for job {job_name} saved to {script_path}\n"
-        )
-        return None
+    Args:
+        job_id: Slurm job ID
+        date: Crawl date string the job is processing
+        check_interval: Base interval in seconds for checking job status
+        max_check_interval: Cap in seconds for the backed-off check interval
+            (default: 5 * check_interval)
+    """
+    states = _squeue_cache.wait_until_terminal(
+        job_id, check_interval, max_check_interval
+    )
 
-    # Submit the job
-    job_id = slurm.sbatch()
-    print(f"Submitted job {job_id} for date {date}")
+    if states:
+        print(f"Job {job_id} for date {date} completed ({', '.join(states)}).")
+    else:
+        print(f"Job {job_id} for date {date} completed.")
 
-    # Wait for this job to complete before continuing
-    job_completed = False
-    while not job_completed:
-        try:
-            result = subprocess.run(
-                ["squeue", "-j", str(job_id)],
-                capture_output=True,
-                text=True,
-                check=True,
-            )
-            if str(job_id) not in result.stdout:
-                print(f"Job {job_id} for date {date} completed.")
-                job_completed = True
-            else:
-                print(
-                    f"Job {job_id} for date {date} still running. Checking again in {check_interval} seconds..."
-                )
-                time.sleep(check_interval)
-        except subprocess.CalledProcessError:
-            print(f"Job {job_id} for date {date} completed. (squeue error)")
-            job_completed = True
-        except Exception as e:
-            print(f"Error checking job status: {e}")
-            time.sleep(check_interval)
+
+def submit_and_wait_for_job(
+    date,
+    n_files,
+    template,
+    job_name_prefix="batch_job",
+    partition=None,
+    time_limit=None,
+    mem=None,
+    cpus_per_task=None,
+    check_interval=60,
+    max_check_interval=None,
+    segments_per_task=100,
+    throttle=50,
+    dry_run=False,
+    scripts_archive=None,
+):
+    """
+    Submit a job for one crawl date and wait for it to complete before returning.
+
+    Takes the arguments of submit_only and wait_for_job.
+
+    Returns:
+        Job ID of the completed job (or None in dry-run mode)
+    """
+    job_id = submit_only(
+        date=date,
+        n_files=n_files,
+        template=template,
+        job_name_prefix=job_name_prefix,
+        partition=partition,
+        time_limit=time_limit,
+        mem=mem,
+        cpus_per_task=cpus_per_task,
+        segments_per_task=segments_per_task,
+        throttle=throttle,
+        dry_run=dry_run,
+        scripts_archive=scripts_archive,
+    )
+    if job_id is not None:
+        wait_for_job(job_id, date, check_interval, max_check_interval)
 
     return job_id
 
@@ -146,62 +766,97 @@ def submit_and_wait_for_job(
 def process_crawl_data_sequentially(
     crawl_dates,
     n_files_list,
-    template_content,
+    template,
     job_name_prefix="batch_job",
     partition=None,
     time_limit=None,
     mem=None,
     cpus_per_task=None,
     check_interval=60,
+    max_check_interval=None,
     segments_per_task=100,
     throttle=50,
+    wait=False,
     dry_run=False,
+    scripts_archive=None,
 ):
     """
-    Process each crawl date sequentially, waiting for each job to finish before starting the next.
+    Process each crawl date sequentially.
+
+    By default every date is submitted up front, each job depending on the
+    previous one, so Slurm runs them in order and nothing has to keep polling.
+    With wait=True each job is instead waited on before the next is submitted.
 
     Args:
         crawl_dates: List of crawl date strings
         n_files_list: List of number of files for each crawl date
-        template_content: Template content loaded from file
+        template: string.Template compiled from the template file
         job_name_prefix: Prefix for job names
         partition: SLURM partition (optional)
         time_limit: Time limit as datetime.timedelta (optional)
         mem: Memory request (optional)
         cpus_per_task: CPUs per task (optional)
-        check_interval: How often to check job status in seconds
+        check_interval: Base interval in seconds for checking job status
+        max_check_interval: Cap in seconds for the backed-off check interval
         segments_per_task: Number of segments per task
+        wait: If True, wait for each job to finish before submitting the next
         dry_run: If True, do not submit the jobs; just output the generated scripts
+        scripts_archive: Open tarfile to add dry-run scripts to instead of
+            writing them to generated_scripts/ (optional)
 
     Returns:
-        List of completed job IDs
+        List of submitted job IDs
     """
-    completed_job_ids = []
+    job_ids = []
+    previous_job_id = None
 
-    for i, (date, n_files) in enumerate(zip(crawl_dates, n_files_list)):
-        print(
-            f"\n[{i + 1}/{len(crawl_dates)}] Processing crawl date {date} with {n_files} files"
-        )
+    try:
+        for i, (date, n_files) in enumerate(zip(crawl_dates, n_files_list)):
+            print(
+                f"\n[{i + 1}/{len(crawl_dates)}] Processing crawl date {date} with {n_files} files"
+            )
 
-        job_id = submit_and_wait_for_job(
-            date=date,
-            n_files=n_files,
-            template_content=template_content,
-            job_name_prefix=job_name_prefix,
-            partition=partition,
-            time_limit=time_limit,
-            mem=mem,
-            cpus_per_task=cpus_per_task,
-            check_interval=check_interval,
-            segments_per_task=segments_per_task,
-            throttle=throttle,
-            dry_run=dry_run,
-        )
+            if wait:
+                job_id = submit_and_wait_for_job(
+                    date=date,
+                    n_files=n_files,
+                    template=template,
+                    job_name_prefix=job_name_prefix,
+                    partition=partition,
+                    time_limit=time_limit,
+                    mem=mem,
+                    cpus_per_task=cpus_per_task,
+                    check_interval=check_interval,
+                    max_check_interval=max_check_interval,
+                    segments_per_task=segments_per_task,
+                    throttle=throttle,
+                    dry_run=dry_run,
+                    scripts_archive=scripts_archive,
+                )
+                print(f"Completed job {job_id} for date {date}")
+            else:
+                job_id = submit_only(
+                    date=date,
+                    n_files=n_files,
+                    template=template,
+                    job_name_prefix=job_name_prefix,
+                    partition=partition,
+                    time_limit=time_limit,
+                    mem=mem,
+                    cpus_per_task=cpus_per_task,
+                    segments_per_task=segments_per_task,
+                    throttle=throttle,
+                    after_job_id=previous_job_id,
+                    dry_run=dry_run,
+                    scripts_archive=scripts_archive,
+                )
 
-        completed_job_ids.append(job_id)
-        print(f"Completed job {job_id} for date {date}")
+            job_ids.append(job_id)
+            previous_job_id = job_id
+    finally:
+        _squeue_cache.stop()
 
-    return completed_job_ids
+    return job_ids
 
 
 def main():
@@ -221,7 +876,12 @@ def main():
         "--check-interval",
         type=int,
         default=60,
-        help="How often to check job status (seconds)",
+        help="Base interval for checking job status (seconds)",
+    )
+    parser.add_argument(
+        "--max-check-interval",
+        type=int,
+        help="Cap for the backed-off job status interval (seconds, default: 5x --check-interval)",
     )
     parser.add_argument(
         "--crawl-dates-file", help="Path to file with crawl dates and file counts"
@@ -235,28 +895,42 @@ def main():
         default=50,
         help="Maximum number of concurrent array tasks",
     )
+    parser.add_argument(
+        "--wait",
+        action="store_true",
+        help="Wait for each job to finish before submitting the next, instead of "
+        "chaining them with Slurm dependencies",
+    )
+    parser.add_argument(
+        "--single-array",
+        action="store_true",
+        help="Submit one array job spanning all crawl dates instead of one per date "
+        "(the total task count must fit within the cluster's MaxArraySize)",
+    )
+    parser.add_argument(
+        "--mapping-file",
+        default="mapping.tsv",
+        help="Array task to crawl date/segment table written in --single-array mode",
+    )
     parser.add_argument(
         "--dry-run",
         action="store_true",
         help="Run in dry-run mode (do not submit jobs)",
     )
+    parser.add_argument(
+        "--scripts-archive",
+        help="In dry-run mode, write the generated scripts into this tar file "
+        "instead of generated_scripts/",
+    )
     args = parser.parse_args()
 
-    # Load template from file
-    template_content = load_template_file(args.template_file)
+    # Load template from file and compile it once for all dates
+    template = PresplitTemplate(load_template_file(args.template_file))
 
     # Define crawl dates and corresponding number of files
     # Either use the default values or load from a file if provided
     if args.crawl_dates_file and os.path.exists(args.crawl_dates_file):
-        crawl_dates = []
-        n_files_list = []
-        with open(args.crawl_dates_file, "r") as f:
-            for line in f:
-                if line.strip() and not line.startswith("#"):
-                    parts = line.strip().split()
-                    if len(parts) >= 2:
-                        crawl_dates.append(parts[0])
-                        n_files_list.append(int(parts[1]))
+        crawl_dates, n_files_list = load_crawl_dates(args.crawl_dates_file)
     else:
         # Default values
         crawl_dates = [
@@ -272,27 +946,75 @@ def main():
         ]
         n_files_list = [79840, 64000, 64000, 64000, 64000, 72000, 72000, 72000, 64000]
 
+    if args.wait and not args.dry_run:
+        _squeue_cache.only_job_state = squeue_has_only_job_state()
+
     # Convert time to timedelta
     time_limit = datetime.timedelta(hours=args.time)
 
-    # Process the jobs sequentially
-    completed_job_ids = process_crawl_data_sequentially(
-        crawl_dates=crawl_dates,
-        n_files_list=n_files_list,
-        template_content=template_content,
-        job_name_prefix=args.job_prefix,
-        partition=args.partition,
-        time_limit=time_limit,
-        mem=args.mem,
-        cpus_per_task=args.cpus,
-        check_interval=args.check_interval,
-        segments_per_task=args.segments_per_task,
-        throttle=args.throttle,
-        dry_run=args.dry_run,
-    )
+    scripts_archive = None
+    if args.dry_run:
+        if args.scripts_archive:
+            scripts_archive = tarfile.open(args.scripts_archive, "w")
+        else:
+            os.makedirs(GENERATED_SCRIPTS_DIR, exist_ok=True)
+
+    try:
+        if args.single_array:
+            # One array for every date; tasks run as the throttle allows rather
+            # than date by date
+            job_id = submit_single_array(
+                crawl_dates=crawl_dates,
+                n_files_list=n_files_list,
+                template=template,
+                mapping_file=args.mapping_file,
+                job_name_prefix=args.job_prefix,
+                partition=args.partition,
+                time_limit=time_limit,
+                mem=args.mem,
+                cpus_per_task=args.cpus,
+                segments_per_task=args.segments_per_task,
+                throttle=args.throttle,
+                dry_run=args.dry_run,
+                scripts_archive=scripts_archive,
+            )
+            if args.wait and job_id is not None:
+                try:
+                    wait_for_job(
+                        job_id, "all", args.check_interval, args.max_check_interval
+                    )
+                finally:
+                    _squeue_cache.stop()
+            job_ids = [job_id]
+        else:
+            # Process the jobs sequentially
+            job_ids = process_crawl_data_sequentially(
+                crawl_dates=crawl_dates,
+                n_files_list=n_files_list,
+                template=template,
+                job_name_prefix=args.job_prefix,
+                partition=args.partition,
+                time_limit=time_limit,
+                mem=args.mem,
+                cpus_per_task=args.cpus,
+                check_interval=args.check_interval,
+                max_check_interval=args.max_check_interval,
+                segments_per_task=args.segments_per_task,
+                throttle=args.throttle,
+                wait=args.wait,
+                dry_run=args.dry_run,
+                scripts_archive=scripts_archive,
+            )
+    finally:
+        if scripts_archive is not None:
+            scripts_archive.close()
 
-    print("\nAll jobs completed successfully!")
-    print(f"Completed jobs: {completed_job_ids}")
+    if args.wait or args.dry_run:
+        print("\nAll jobs completed successfully!")
+        print(f"Completed jobs: {job_ids}")
+    else:
+        print("\nAll jobs submitted.")
+        print(f"Submitted jobs: {job_ids}")
 
 
 if __name__ == "__main__":